@@ -2,15 +2,25 @@
 
 Meant to be used with github workflows
 """
-from typing import Generator
+from typing import Callable, Generator, Optional
+from contextlib import contextmanager
+from collections import Counter
 import os
 import json
+import hashlib
 import logging
 from pathlib import Path
-import shutil
-import tempfile
 import zipfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+try:
+    ##orjson parses considerably faster, but is not required
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 from datetime import datetime as dt
 
@@ -22,8 +32,8 @@ from inkBoard.types import manifestjson, platformjson
 from inkBoard.packaging.constants import ZIP_COMPRESSION, ZIP_COMPRESSION_LEVEL
 from inkBoard.packaging.version import parse_version, write_version_filename
 
-import inkBoarddesigner
-import PythonScreenStackManager
+##Versions are immutable, so parsed versions can be reused for all the packages and branches sharing a version string
+parse_version = lru_cache(maxsize=256)(parse_version)
 
 _LOGGER = inkBoard.getLogger(__name__)
 _LOGGER.setLevel(logging.INFO)
@@ -41,24 +51,80 @@ INTEGRATION_INDEX_FOLDER = INDEX_FOLDER / "integrations"
 PLATFORM_INDEX_FOLDER = INDEX_FOLDER / "platforms"
 ARCHIVE_FOLDER_STR = "versions"
 
+##Names of files and folders that are not packaged, at any depth of the package folder
+INTEGRATION_IGNORE = frozenset({"__pycache__", "designer", "designer.py"})
+PLATFORM_IGNORE = frozenset({"__pycache__", "emulator.json", "designer.py", "designer"})
+
 DEV_PATTERN = r"([0-9.]+)_dev.zip"
 MAIN_PATTERN = r"([0-9.]+).zip"
 
-if INDEX_FILE.exists():
-    with open(INDEX_FILE, "r") as file:
-        current_index = json.load(file)
-else:
-    current_index = {
+##Zstandard compression for zip files is only available from Python 3.14 onwards, see `load_zstandard` for older versions
+##93 is the compression method number of Zstandard in the zip specification
+ZIP_ZSTANDARD = getattr(zipfile, "ZIP_ZSTANDARD", 93)
+ZSTD_COMPRESSION_LEVEL = 3
+
+##Compression levels accepted per compression method, methods without levels are not listed
+##The lowest Zstandard level is its negative fast level, -(1 << 17)
+COMPRESSION_LEVEL_RANGES = {
+    zipfile.ZIP_DEFLATED: range(-1, 10),
+    zipfile.ZIP_BZIP2: range(1, 10),
+    ZIP_ZSTANDARD: range(-(1 << 17), 23),
+}
+
+##Dev packages are replaced often, so they are compressed for speed rather than size
+DEV_COMPRESSION_LEVEL = 1
+
+##Files that are already compressed, and are stored in the zip files as is
+STORED_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".webp", ".gif", ".woff", ".woff2", ".zip", ".gz", ".xz", ".bz2", ".br"})
+
+##Timestamp given to all files in package zips, so zipping the same files always gives the same zip file
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+##Chunk size used to copy files into package zips
+ZIP_WRITE_BUFFER_SIZE = 1 << 20
+
+def load_zstandard() -> bool:
+    """Makes sure the zipfile module can write Zstandard compressed files, and returns whether it can
+
+    Before Python 3.14, this requires zipfile-zstd. That package patches internals of the zipfile module, so it is only imported when Zstandard is actually used.
+    It also compresses each zip with 12 threads, which is not configurable, so packaging in parallel with it can use many more threads than there are processors.
+    """
+    if hasattr(zipfile, "ZIP_ZSTANDARD"):
+        return True
+    try:
+        import zipfile_zstd
+    except ImportError:
+        return False
+    return True
+
+def get_package_versions() -> dict[str, str]:
+    """Gets the versions of inkBoard, PythonScreenStackManager and inkBoarddesigner for the index
+
+    The designer and PythonScreenStackManager are only needed for their versions, and importing them is slow.
+    So they are imported here, instead of at module level, which also keeps them out of the packaging worker processes.
+    """
+    import inkBoarddesigner
+    import PythonScreenStackManager
+
+    return {
         "inkBoard": inkBoard.__version__,
         "PythonScreenStackManager": PythonScreenStackManager.__version__,
         "inkBoarddesigner": inkBoarddesigner.__version__,
+        }
+
+if INDEX_FILE.exists():
+    current_index = json_loads(INDEX_FILE.read_bytes())
+else:
+    current_index = {
+        **get_package_versions(),
         "timestamp": dt.fromtimestamp(0).isoformat(),
         "platforms": {},
         "integrations": {"api": {"main": "1.0.0"}},
         }
 
-integration_index = current_index["integrations"].copy()
-platform_index = current_index["platforms"].copy()
+##The package dicts inside are updated in place, so copying these would not isolate them from current_index anyways
+integration_index = current_index.setdefault("integrations", {})
+platform_index = current_index.setdefault("platforms", {})
 
 class inkBoardIndexingError(Exception):
     "Base exception for errors in the indexing process"
@@ -80,193 +146,244 @@ def parse_arguments():
     parser.add_argument('--dev', action='store_true', dest='dev',
                         help="Assumed zip packages created are dev packages, and appends _dev to the packages",
                         default=DEBUGGING)
-    return parser.parse_args()
+    parser.add_argument('--zstd', action='store_true', dest='zstd',
+                        help="Compress packages with Zstandard instead of the default compression. Requires Python 3.14 or the zipfile-zstd package, and the same to unpack the packages",
+                        default=False)
+    parser.add_argument('--compresslevel', type=int, dest='compresslevel',
+                        help="Compression level for the packages, lower levels compress faster. Defaults to the level of the chosen compression, or 1 for dev packages",
+                        default=None)
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs',
+                        help="Maximum number of packages to zip in parallel, defaults to the number of processors. Use 1 to zip in the main process",
+                        default=None)
+    parser.add_argument('--check-unchanged', action='store_true', dest='check_unchanged',
+                        help="Warn about packages whose files changed without a version bump. Hashes the files of every unchanged package, so it makes runs slower",
+                        default=False)
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+                        help="Log debug messages, and the generated index",
+                        default=False)
+    args = parser.parse_args()
+    if args.zstd and not load_zstandard():
+        parser.error("Zstandard compression requires Python 3.14 or newer, or the zipfile-zstd package")
+    if args.compresslevel is not None:
+        levels = COMPRESSION_LEVEL_RANGES.get(ZIP_ZSTANDARD if args.zstd else ZIP_COMPRESSION)
+        if levels is not None and args.compresslevel not in levels:
+            parser.error(f"--compresslevel must be between {levels.start} and {levels.stop - 1} for the chosen compression")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
 
 def gather_folders(base_folder) -> Generator[Path, None, None]:
     """Gathers all folders in the base_folder, provided they do not start with an `_`"""
 
-    for p in Path(base_folder).iterdir():
-        if p.is_dir() and not p.name.startswith("_"):
-            yield p
+    with os.scandir(base_folder) as it:
+        for entry in it:
+            if not entry.name.startswith("_") and entry.is_dir():
+                yield Path(entry.path)
 
-def create_integration_index(dev_mode: bool):
+def list_index_zips(index_root: Path) -> dict[str, set[str]]:
+    """Lists the zip files in each package folder of `index_root`, so the indexing loop does not need to rescan them
 
-    pack_type = "integration"
-    folder = constants.DESIGNER_FOLDER / "integrations"
-    int_folders = gather_folders(folder)
-    err_dict = {}
-    for p in int_folders:
-        manifest_file = p / "manifest.json"
-        if not manifest_file.exists():
-            msg = f"No manifest file for {pack_type} folder {p}"
-            _LOGGER.error(msg)
-            err_dict[p.name] = FileIndexError(msg)
-            continue
-
-        branch = "dev" if dev_mode else "main"
-        with open(manifest_file) as file:
-            d = manifestjson(**json.load(file))
-
-        index_folder = INTEGRATION_INDEX_FOLDER / p.name
-        old_package = None
-        make_package = False
-        archive_old_package = False
+    Parameters
+    ----------
+    index_root : Path
+        The integration or platform index folder
 
-        manifest_version = parse_version(d["version"])
-        if p.name in integration_index:
-            index_version = parse_version(integration_index[p.name].get(branch, "0.0.0"))
-            integration_index[p.name][branch] = d["version"]
-        else:
-            index_version = parse_version("0.0.0")
-            integration_index[p.name] = {branch: d["version"]}
+    Returns
+    -------
+    dict[str, set[str]]
+        Dict with the package folder names as keys, and the names of the zip files directly in them as values
+    """
+    with os.scandir(index_root) as it:
+        return {entry.name: list_zips(entry.path) for entry in it if entry.is_dir()}
 
-        if index_version == manifest_version:
-            ##Same version, means it does not have to be made. Only make for new versions
-            _LOGGER.debug(f"{pack_type.capitalize()} {p.name} did not change version")
-            continue
-        elif index_version > manifest_version:
-            ##Version went down. Should not happen and is weird.
-            msg = f"{pack_type.capitalize()} {p.name} has an index version larger than the current manifest version"
-            _LOGGER.error(msg)
-            err_dict[p.name] = VersionError(msg)
-            continue
-        elif branch == "main" and manifest_version.is_prerelease:
-            ##branch cannot be main and return a prerelease version
-            msg = f"{pack_type.capitalize()} {p.name} has a prerelease version in the main branch"
-            _LOGGER.error(msg)
-            err_dict[p.name] = VersionError(msg)
-            continue
+def list_zips(folder: Path) -> set[str]:
+    "Returns the names of the zip files directly in `folder`, using a single directory scan"
+    with os.scandir(folder) as it:
+        return {entry.name for entry in it if entry.name.endswith(".zip") and entry.is_file()}
 
-        if not index_folder.exists():
-            _LOGGER.info(f"Making folder for {pack_type} {p.name}")
-            index_folder.mkdir()
-            (index_folder / ARCHIVE_FOLDER_STR).mkdir()
-            make_package = True
+def package_filename(name: str, version, dev_mode: bool) -> str:
+    "Returns the filename of the package zip of `name` at `version`, for the dev branch if `dev_mode`, otherwise for the main branch"
+    if dev_mode:
+        return write_version_filename(name, version, "_dev.zip")
+    return write_version_filename(name, version)
 
-            if dev_mode:
-                package_name =  index_folder / index_folder / write_version_filename(p.name, manifest_version, "_dev.zip")
-            else:
-                package_name =  index_folder / write_version_filename(p.name, manifest_version)
+def create_package_zips(pack_type: str, zip_function: Callable[[Path, Path, int, int], None], zip_jobs: dict[str, tuple[Path, Path]],
+                        compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL, max_workers: Optional[int] = None) -> dict[str, PackagingError]:
+    """Creates the zip files of multiple packages in parallel, using a process pool
 
-        elif dev_mode:
-            make_package = True
-            package_name =  index_folder / write_version_filename(p.name, manifest_version, "_dev.zip")
-            old_package =  index_folder / write_version_filename(p.name, index_version, "_dev.zip")
-            if old_package.exists() and index_version.is_prerelease:
-                ##Do not want to archive mainline versions which do not come from the main branch
-                archive_old_package = True
-        else:
-            make_package = True
-            package_name =  index_folder / write_version_filename(p.name, manifest_version)
-            old_package =  index_folder / write_version_filename(p.name, index_version)
-            if old_package.exists():
-                archive_old_package = True
+    Compressing is the most expensive part of indexing, and each package can be zipped independently.
 
-        if archive_old_package:
-            archive_package = index_folder / ARCHIVE_FOLDER_STR / write_version_filename(p.name, index_version)
-            if archive_package.exists():
-                ##Check if the version does not exist in the archive yet
-                msg = f"Archived {pack_type} package file {archive_package.name} already exists"
-                _LOGGER.error(msg + ". Not Archiving")
-                err_dict[p.name] = FileIndexError(msg)
-                continue
-            
-            _LOGGER.info(f"Archiving old {pack_type} package {old_package.name} to {archive_package.name}")
-            old_package.replace(archive_package)
-        elif old_package and old_package.exists():
-            ##If branch == "main", the exists check is already performed and causes archive to be set to True.
-            _LOGGER.info(f"Removing old {pack_type} package {old_package.name}")
-            os.remove(old_package)
+    Parameters
+    ----------
+    pack_type : str
+        The type of package being zipped, used for logging
+    zip_function : Callable[[Path, Path, int, int], None]
+        The function creating a zip file, i.e. `create_integration_zip` or `create_platform_zip`
+    zip_jobs : dict[str, tuple[Path, Path]]
+        Dict with package names as keys, and a tuple with the package folder and the zip file to create as values
+    compression : int, optional
+        The compression method to use, by default `ZIP_COMPRESSION`
+    compresslevel : int, optional
+        The compression level to use, by default `ZIP_COMPRESSION_LEVEL`
+    max_workers : Optional[int], optional
+        The maximum number of worker processes, by default None (the number of processors).
+        If 1, or if there is only one package, the zip files are created in the main process.
 
-        if len(list(index_folder.glob("*.zip"))) > 1:
-            ##Check to see if the current folder structure is ok to make a new package in
-            msg = f"There are two or more packages in the main folder {index_folder} of {pack_type} {p.name} now, will not create new {pack_type} package {package_name.name}"
-            _LOGGER.error(msg)
-            err_dict[p.name] = FileIndexError(msg)
-            continue
+    Returns
+    -------
+    dict[str, PackagingError]
+        Errors for the packages that could not be zipped
+    """
+    err_dict = {}
+    if not zip_jobs:
+        return err_dict
+
+    if max_workers == 1 or len(zip_jobs) == 1:
+        ##No use starting worker processes to zip one package at a time
+        for name, (folder, zip_file_path) in zip_jobs.items():
+            try:
+                zip_function(folder, zip_file_path, compression, compresslevel)
+            except Exception as exc:
+                err_dict[name] = packaging_failed(pack_type, name, zip_file_path, exc)
+        return err_dict
+
+    ##Worker processes are not necessarily forked, so they need to load zipfile-zstd themselves
+    initializer = load_zstandard if compression == ZIP_ZSTANDARD else None
+    with ProcessPoolExecutor(max_workers, initializer=initializer) as executor:
+        futures = {name: executor.submit(zip_function, folder, zip_file_path, compression, compresslevel) for name, (folder, zip_file_path) in zip_jobs.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as exc:
+                err_dict[name] = packaging_failed(pack_type, name, zip_jobs[name][1], exc)
+    return err_dict
+
+def packaging_failed(pack_type: str, name: str, zip_file_path: Path, exc: Exception) -> PackagingError:
+    "Logs a failed package zip, removes the partially written zip file and returns the error for it"
+    msg = f"Failed to package {pack_type} {name}: {exc}"
+    _LOGGER.error(msg)
+    ##Remove partially written packages, they would block the next run
+    zip_file_path.unlink(missing_ok=True)
+    return PackagingError(msg)
+
+def create_package_index(*, pack_type: str, source_folder: Path, index_root: Path, manifest_filename: str, json_model: type,
+                        package_index: dict, ignore: frozenset[str], zip_function: Callable[[Path, Path, int, int], None], dev_mode: bool,
+                        compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL, max_workers: Optional[int] = None,
+                        check_unchanged: bool = False) -> dict:
+    """Updates the index of a type of package, and packages the new versions
 
-        if make_package:
-            create_integration_zip(p, package_name)
+    Parameters
+    ----------
+    pack_type : str
+        The type of package, i.e. integration or platform. Used for logging
+    source_folder : Path
+        The folder with the package folders to index, i.e. the integrations folder of the designer
+    index_root : Path
+        The folder in the index that holds the package folders
+    manifest_filename : str
+        The name of the file in each package folder holding the version, i.e. manifest.json
+    json_model : type
+        The type to parse the manifest file contents into
+    package_index : dict
+        The index of this type of package, which is updated in place
+    ignore : frozenset[str]
+        File and folder names that are not packaged
+    zip_function : Callable[[Path, Path, int, int], None]
+        The function creating the zip file of a package
+    dev_mode : bool
+        Whether to index the dev branch
+    compression : int, optional
+        The compression method to use, by default `ZIP_COMPRESSION`
+    compresslevel : int, optional
+        The compression level to use, by default `ZIP_COMPRESSION_LEVEL`
+    max_workers : Optional[int], optional
+        The maximum number of processes to zip packages with, by default None
+    check_unchanged : bool, optional
+        Warn about packages whose sources changed without a version bump, by default False.
+        This hashes the sources of every package that did not change version, so it is opt-in.
 
-    if err_dict:
-        d = {}
-        for k, v in err_dict.items():
-            d.setdefault(v, 0)
-            d[v] += 1
-        msg = f"Errors while creating {pack_type} index: {d}. See logs for more details"
-        raise inkBoardIndexingError(msg)
-    return integration_index
+    Returns
+    -------
+    dict
+        The updated `package_index`
 
-def create_platform_index(dev_mode: bool):
-    pack_type = "platform"
-    folder = constants.DESIGNER_FOLDER / "platforms"
-    int_folders = gather_folders(folder)
+    Raises
+    ------
+    inkBoardIndexingError
+        Raised if any package could not be indexed or packaged
+    """
+    branch = "dev" if dev_mode else "main"
+    folders = gather_folders(source_folder)
+    index_zips = list_index_zips(index_root)
     err_dict = {}
-    for p in int_folders:
-        platform_file = p / "platform.json"
-        if not platform_file.exists():
-            msg = f"No platform file for {pack_type} folder {p}"
+    zip_jobs = {}
+    new_versions = {}
+    for p in folders:
+        manifest_file = p / manifest_filename
+        try:
+            ##Reading directly instead of checking exists() first saves a stat per package
+            d = json_model(**json_loads(manifest_file.read_bytes()))
+        except FileNotFoundError:
+            msg = f"No {manifest_filename} for {pack_type} folder {p}"
             _LOGGER.error(msg)
             err_dict[p.name] = FileIndexError(msg)
             continue
 
-        branch = "dev" if dev_mode else "main"
-        with open(platform_file) as file:
-            d = platformjson(**json.load(file))
-
-        index_folder = PLATFORM_INDEX_FOLDER / p.name
+        index_folder = index_root / p.name
+        index_folder_exists = p.name in index_zips
+        folder_zips = index_zips.setdefault(p.name, set())
         old_package = None
         make_package = False
         archive_old_package = False
 
-        platform_version = parse_version(d["version"])
-        if p.name in platform_index:
-            index_version = parse_version(platform_index[p.name].get(branch, "0.0.0"))
-            platform_index[p.name][branch] = d["version"]
-        else:
-            index_version = parse_version("0.0.0")
-            platform_index[p.name] = {branch: d["version"]}
+        manifest_version = parse_version(d["version"])
+        index_version = parse_version(package_index.get(p.name, {}).get(branch, "0.0.0"))
+        package_name = index_folder / package_filename(p.name, manifest_version, dev_mode)
 
-        if index_version == platform_version:
+        if index_version == manifest_version:
             ##Same version, means it does not have to be made. Only make for new versions
-            _LOGGER.debug(f"{pack_type.capitalize()} {p.name} did not change version")
+            ##Lazy formatting, since this is logged for nearly every package but filtered out unless running verbose
+            _LOGGER.debug("%s %s did not change version", pack_type.capitalize(), p.name)
+            if check_unchanged and package_name.name in folder_zips:
+                ##Packages made before source hashes were stored have none, and cannot be checked
+                package_hash = read_package_hash(package_name)
+                try:
+                    source_changed = package_hash and package_hash != hash_package_folder(p, ignore)
+                except OSError as exc:
+                    ##Only a warning, the package is not rebuilt so this should not fail the index
+                    _LOGGER.warning(f"Could not check if {pack_type} {p.name} changed since package {package_name.name} was made: {exc}")
+                    source_changed = False
+                if source_changed:
+                    _LOGGER.warning(f"{pack_type.capitalize()} {p.name} changed since package {package_name.name} was made, but its version did not. Bump the version to update the package")
             continue
-        elif index_version > platform_version:
+        elif index_version > manifest_version:
             ##Version went down. Should not happen and is weird.
-            msg = f"{pack_type.capitalize()} {p.name} has an index version larger than the current platform version"
+            msg = f"{pack_type.capitalize()} {p.name} has an index version larger than the current {manifest_filename} version"
             _LOGGER.error(msg)
             err_dict[p.name] = VersionError(msg)
             continue
-        elif branch == "main" and platform_version.is_prerelease:
+        elif branch == "main" and manifest_version.is_prerelease:
             ##branch cannot be main and return a prerelease version
             msg = f"{pack_type.capitalize()} {p.name} has a prerelease version in the main branch"
             _LOGGER.error(msg)
             err_dict[p.name] = VersionError(msg)
             continue
 
-        if not index_folder.exists():
+        if not index_folder_exists:
             _LOGGER.info(f"Making folder for {pack_type} {p.name}")
             index_folder.mkdir()
             (index_folder / ARCHIVE_FOLDER_STR).mkdir()
             make_package = True
-
-            if dev_mode:
-                package_name =  index_folder / write_version_filename(p.name, platform_version, "_dev.zip")
-            else:
-                package_name =  index_folder / write_version_filename(p.name, platform_version)
-
         elif dev_mode:
             make_package = True
-            package_name =  index_folder / write_version_filename(p.name, platform_version, "_dev.zip")
-            old_package =  index_folder / write_version_filename(p.name, index_version, "_dev.zip")
-            if old_package.exists() and index_version.is_prerelease:
+            old_package =  index_folder / package_filename(p.name, index_version, dev_mode)
+            if old_package.name in folder_zips and index_version.is_prerelease:
                 ##Do not want to archive mainline versions which do not come from the main branch
                 archive_old_package = True
         else:
             make_package = True
-            package_name =  index_folder / write_version_filename(p.name, platform_version)
-            old_package =  index_folder / write_version_filename(p.name, index_version)
-            if old_package.exists():
+            old_package =  index_folder / package_filename(p.name, index_version, dev_mode)
+            if old_package.name in folder_zips:
                 archive_old_package = True
 
         if archive_old_package:
@@ -280,29 +397,82 @@ def create_platform_index(dev_mode: bool):
             
             _LOGGER.info(f"Archiving old {pack_type} package {old_package.name} to {archive_package.name}")
             old_package.replace(archive_package)
-        elif old_package and old_package.exists():
+            folder_zips.discard(old_package.name)
+        elif old_package and old_package.name in folder_zips:
             ##If branch == "main", the exists check is already performed and causes archive to be set to True.
             _LOGGER.info(f"Removing old {pack_type} package {old_package.name}")
             os.remove(old_package)
+            folder_zips.discard(old_package.name)
 
-        if len(list(index_folder.glob("*.zip"))) > 1:
+        if len(folder_zips - {package_name.name}) > 1:
             ##Check to see if the current folder structure is ok to make a new package in
+            ##The package being made is left out, it may be there already from an interrupted run and is checked below
             msg = f"There are two or more packages in the main folder {index_folder} of {pack_type} {p.name} now, will not create new {pack_type} package {package_name.name}"
             _LOGGER.error(msg)
             err_dict[p.name] = FileIndexError(msg)
             continue
 
         if make_package:
-            create_platform_zip(p, package_name)
+            new_versions[p.name] = d["version"]
+            package_current = False
+            if package_name.name in folder_zips:
+                try:
+                    package_current = package_is_current(package_name, hash_package_folder(p, ignore))
+                except OSError:
+                    ##The zip job runs into the same problem, and reports it as a packaging error
+                    package_current = False
+            if package_current:
+                _LOGGER.info(f"{pack_type.capitalize()} package {package_name.name} already exists and is up to date, not recreating it")
+            else:
+                zip_jobs[p.name] = (p, package_name)
+                folder_zips.add(package_name.name)
+
+    ##All archiving and removing is done by now, so only zipping is left
+    if err_dict and zip_jobs:
+        ##The index will not be written anyways, so no use in spending time on compressing
+        _LOGGER.warning(f"Not creating {len(zip_jobs)} {pack_type} package(s) since indexing had errors")
+    else:
+        err_dict.update(create_package_zips(pack_type, zip_function, zip_jobs, compression, compresslevel, max_workers))
 
     if err_dict:
-        d = {}
-        for k, v in err_dict.items():
-            d.setdefault(v, 0)
-            d[v] += 1
+        ##Count per error type, the instances themselves are all unique
+        d = dict(Counter(type(v).__name__ for v in err_dict.values()))
         msg = f"Errors while creating {pack_type} index: {d}. See logs for more details"
         raise inkBoardIndexingError(msg)
-    return platform_index
+
+    for name, version in new_versions.items():
+        package_index.setdefault(name, {})[branch] = version
+    return package_index
+
+def create_integration_index(dev_mode: bool, compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL, max_workers: Optional[int] = None, check_unchanged: bool = False):
+    "Indexes the integrations in the designer, and packages the new versions. See `create_package_index`"
+    return create_package_index(
+        pack_type = "integration",
+        source_folder = constants.DESIGNER_FOLDER / "integrations",
+        index_root = INTEGRATION_INDEX_FOLDER,
+        manifest_filename = "manifest.json",
+        json_model = manifestjson,
+        package_index = integration_index,
+        ignore = INTEGRATION_IGNORE,
+        zip_function = create_integration_zip,
+        dev_mode = dev_mode, compression = compression, compresslevel = compresslevel, max_workers = max_workers,
+        check_unchanged = check_unchanged
+        )
+
+def create_platform_index(dev_mode: bool, compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL, max_workers: Optional[int] = None, check_unchanged: bool = False):
+    "Indexes the platforms in the designer, and packages the new versions. See `create_package_index`"
+    return create_package_index(
+        pack_type = "platform",
+        source_folder = constants.DESIGNER_FOLDER / "platforms",
+        index_root = PLATFORM_INDEX_FOLDER,
+        manifest_filename = "platform.json",
+        json_model = platformjson,
+        package_index = platform_index,
+        ignore = PLATFORM_IGNORE,
+        zip_function = create_platform_zip,
+        dev_mode = dev_mode, compression = compression, compresslevel = compresslevel, max_workers = max_workers,
+        check_unchanged = check_unchanged
+        )
 
 
 
@@ -316,78 +486,181 @@ def create_platform_index(dev_mode: bool):
 ##readme is omitted as it should be in the docs anyways
 ##always omit __pycache__
 
-def ignore_files(src, names):
-    """Returns a list with files to not copy for `shutil.copytree`
+def walk_package_folder(folder: Path, ignore: frozenset[str]) -> Generator[tuple[str, str], None, None]:
+    """Recursively walks a package folder and yields the files that should be put into its zip file
+
+    Folders are not yielded themselves, since zip files do not need explicit entries for them.
 
     Parameters
     ----------
-    parentbase_folder : Path
-        The base folder being copied from
-    src : str
-        source path, passed by `copytree`
-    names : list[str]
-        list with file and folder names, passed by `copytree`
-    ignore_in_baseparent_folder : set, optional
-        Set with filenames to ignore (i.e. not copy), _Only if_ the parent folder of `src` is `base_ignore_folder`, by default {}
+    folder : Path
+        The integration or platform folder to walk
+    ignore : frozenset[str]
+        File and folder names to skip (i.e. not package), at any depth
+
+    Yields
+    ------
+    tuple[str, str]
+        The path of the file, and its name in the archive, relative to the parent of `folder`
+    """
+    folder = Path(folder)
+    yield from _walk_package_folder(str(folder), folder.name, ignore)
+
+def _walk_package_folder(path: str, arc_prefix: str, ignore: frozenset[str]) -> Generator[tuple[str, str], None, None]:
+    ##Archive names are built up during the recursion, zip files always use / as separator
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name in ignore:
+                continue
+            arcname = arc_prefix + "/" + entry.name
+            if entry.is_dir():
+                yield from _walk_package_folder(entry.path, arcname, ignore)
+            else:
+                yield entry.path, arcname
+
+def hash_package_folder(folder: Path, ignore: frozenset[str]) -> str:
+    """Computes a sha256 hash of the names and contents of everything in a package folder that would be zipped
+
+    Gives the same hash as the one `write_zip_entry` computes while zipping the package.
+
+    Parameters
+    ----------
+    folder : Path
+        The integration or platform folder
+    ignore : frozenset[str]
+        File and folder names that are not packaged
 
     Returns
     -------
-    _type_
-        _description_
+    str
+        The hexdigest of the hash
     """
-    return {"__pycache__"}
+    sha = hashlib.sha256()
+    for path, arcname in sorted(walk_package_folder(folder, ignore), key=lambda x: x[1]):
+        sha.update(arcname.encode() + b"\0")
+        with open(path, "rb", buffering=0) as file:
+            for chunk in iter(lambda: file.read(ZIP_WRITE_BUFFER_SIZE), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def read_package_hash(zip_file_path: Path) -> Optional[str]:
+    "Reads the source hash stored in the comment of a package zip. Returns None if it cannot be read, or if the package has none"
+    try:
+        with zipfile.ZipFile(zip_file_path) as zip_file:
+            return zip_file.comment.decode() or None
+    except (OSError, UnicodeDecodeError, zipfile.BadZipFile):
+        return None
+
+def package_is_current(zip_file_path: Path, package_hash: str) -> bool:
+    """Checks if an existing package zip was created from source files with hash `package_hash`, which is stored in the zip comment"""
+    return read_package_hash(zip_file_path) == package_hash
+
+@contextmanager
+def open_package_zip(zip_file_path: Path, compression: int, compresslevel: int) -> Generator[zipfile.ZipFile, None, None]:
+    """Opens a new package zip file for writing, and syncs it to disk once it is closed
+
+    Syncing once per package makes sure finished packages survive a crash of the runner, without syncing every file written.
 
-def create_integration_zip(integration_folder: Path, zip_file_path: Path):
+    Parameters
+    ----------
+    zip_file_path : Path
+        The zip file to create
+    compression : int
+        The compression method to use
+    compresslevel : int
+        The compression level to use
+
+    Yields
+    ------
+    zipfile.ZipFile
+        The opened zip file
+    """
+    with open(zip_file_path, "wb", buffering=ZIP_WRITE_BUFFER_SIZE) as file:
+        with zipfile.ZipFile(file, 'w', compression, compresslevel=compresslevel, strict_timestamps=False) as zip_file:
+            yield zip_file
+        file.flush()
+        os.fsync(file.fileno())
 
-    ##As per packaging: first create temp directory
-    ##When that is done, put all files in there into the zipfile
+def write_zip_entry(zip_file: zipfile.ZipFile, path: str, arcname: str, compression: int, compresslevel: int, package_hash):
+    """Writes a file into an open zip file, copying it in chunks of `ZIP_WRITE_BUFFER_SIZE`
 
-    with tempfile.TemporaryDirectory(dir=str(INTEGRATION_INDEX_FOLDER)) as tempdir:
-        name = integration_folder.name
-        _LOGGER.info(f"Gathering integration {name}")
-        shutil.copytree(
-            src = integration_folder,
-            dst= Path(tempdir) / name,
-            ignore=lambda *args: ("__pycache__", "designer", "designer.py")
-        )
+    Does the same as `ZipFile.write`, which copies in chunks of 8 KiB, so larger assets like fonts and images take a lot of reads.
+    Files with an extension in `STORED_EXTENSIONS` are not compressed, since that would not make them any smaller.
+    All files get `ZIP_DATE_TIME` as timestamp, so packages are reproducible. File permissions are kept.
 
-        _LOGGER.debug(f"Zipping up integration {name} to {zip_file_path}")
-        with zipfile.ZipFile(zip_file_path, 'w', ZIP_COMPRESSION, compresslevel=ZIP_COMPRESSION_LEVEL) as zip_file:
-            for foldername, subfolders, filenames in os.walk(tempdir):
-                _LOGGER.verbose(f"Zipping contents of folder {foldername}")
-                for filename in filenames:
-                    file_path = os.path.join(foldername, filename)
-                    zip_file.write(file_path, os.path.relpath(file_path, tempdir))
-                for dir in subfolders:
-                    dir_path = os.path.join(foldername, dir)
-                    zip_file.write(dir_path, os.path.relpath(dir_path, tempdir))
-        _LOGGER.info(f"Succesfully packaged integration {name}")
-    return
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        The zip file to write to
+    path : str
+        Path to the file to write
+    arcname : str
+        The name of the file in the archive
+    compression : int
+        The compression method to use
+    compresslevel : int
+        The compression level to use
+    package_hash
+        A `hashlib` hash object to update with the archive name and contents of the file while it is copied
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    zinfo.date_time = ZIP_DATE_TIME
+    if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+        compression = zipfile.ZIP_STORED
+    zinfo.compress_type = compression
+    ##Python 3.13 renamed the private _compresslevel to compress_level, and only keeps the old name as an alias
+    if hasattr(zipfile.ZipInfo, "compress_level"):
+        zinfo.compress_level = compresslevel
+    else:
+        zinfo._compresslevel = compresslevel
+    ##Files are read in large chunks already, so an additional read buffer would only copy the data around
+    with open(path, "rb", buffering=0) as src, zip_file.open(zinfo, "w") as dst:
+        package_hash.update(arcname.encode() + b"\0")
+        for chunk in iter(lambda: src.read(ZIP_WRITE_BUFFER_SIZE), b""):
+            package_hash.update(chunk)
+            dst.write(chunk)
 
-def create_platform_zip(platform_folder: Path, zip_file_path: Path):
-    
-    with tempfile.TemporaryDirectory(dir=str(INTEGRATION_INDEX_FOLDER)) as tempdir:
-        name = platform_folder.name
-        _LOGGER.info(f"Gathering platform {name}")
-        shutil.copytree(
-            src = platform_folder,
-            dst= Path(tempdir) / name,
-            ignore=lambda *args: ("__pycache__", "emulator.json", "designer.py", "designer")
-        )
+def create_package_zip(pack_type: str, package_folder: Path, zip_file_path: Path, ignore: frozenset[str],
+                    compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL):
+    """Creates the zip file of a package
 
-        _LOGGER.debug(f"Zipping up platform {name} to {zip_file_path}")
-        with zipfile.ZipFile(zip_file_path, 'w', ZIP_COMPRESSION, compresslevel=ZIP_COMPRESSION_LEVEL) as zip_file:
-            for foldername, subfolders, filenames in os.walk(tempdir):
-                _LOGGER.verbose(f"Zipping contents of folder {foldername}")
-                for filename in filenames:
-                    file_path = os.path.join(foldername, filename)
-                    zip_file.write(file_path, os.path.relpath(file_path, tempdir))
-                for dir in subfolders:
-                    dir_path = os.path.join(foldername, dir)
-                    zip_file.write(dir_path, os.path.relpath(dir_path, tempdir))
-        _LOGGER.info(f"Succesfully packaged platform {name}")
+    Files are read straight from the designer folder, without copying them to a temporary directory first.
+
+    Parameters
+    ----------
+    pack_type : str
+        The type of package, used for logging
+    package_folder : Path
+        The folder of the package
+    zip_file_path : Path
+        The zip file to create
+    ignore : frozenset[str]
+        File and folder names that are not packaged
+    compression : int, optional
+        The compression method to use, by default `ZIP_COMPRESSION`
+    compresslevel : int, optional
+        The compression level to use, by default `ZIP_COMPRESSION_LEVEL`
+    """
+    name = package_folder.name
+    _LOGGER.info(f"Zipping up {pack_type} {name} to {zip_file_path}")
+    ##The source hash allows reruns to recognise a package that is already up to date
+    ##Files are added in sorted order so it is computed while zipping, without reading the files twice
+    package_hash = hashlib.sha256()
+    with open_package_zip(zip_file_path, compression, compresslevel) as zip_file:
+        for path, arcname in sorted(walk_package_folder(package_folder, ignore), key=lambda x: x[1]):
+            write_zip_entry(zip_file, path, arcname, compression, compresslevel, package_hash)
+        zip_file.comment = package_hash.hexdigest().encode()
+    _LOGGER.info(f"Succesfully packaged {pack_type} {name}")
     return
 
+def create_integration_zip(integration_folder: Path, zip_file_path: Path, compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL):
+    "Creates the zip file of an integration. See `create_package_zip`"
+    return create_package_zip("integration", integration_folder, zip_file_path, INTEGRATION_IGNORE, compression, compresslevel)
+
+def create_platform_zip(platform_folder: Path, zip_file_path: Path, compression: int = ZIP_COMPRESSION, compresslevel: int = ZIP_COMPRESSION_LEVEL):
+    "Creates the zip file of a platform. See `create_package_zip`"
+    return create_package_zip("platform", platform_folder, zip_file_path, PLATFORM_IGNORE, compression, compresslevel)
+
 def folder_setup():
     if DEBUGGING and not INDEX_FOLDER.exists():
         INDEX_FOLDER.mkdir()
@@ -401,6 +674,44 @@ def folder_setup():
         PLATFORM_INDEX_FOLDER.mkdir()
         _LOGGER.info(f"Created platform folder {PLATFORM_INDEX_FOLDER}")
 
+def write_index(index: dict) -> bool:
+    """Writes the index to the index file, if anything besides the timestamp changed
+
+    The index is written to a temporary file first and then moved in place, so an interrupted run cannot leave a corrupt index file behind.
+
+    Parameters
+    ----------
+    index : dict
+        The new index
+
+    Returns
+    -------
+    bool
+        Whether the index file was written
+    """
+    try:
+        old_index = json_loads(INDEX_FILE.read_bytes())
+    except (OSError, ValueError):
+        old_index = None
+
+    if old_index is not None and {**old_index, "timestamp": index["timestamp"]} == index:
+        return False
+
+    tmp_file = INDEX_FILE.with_suffix(".json.tmp")
+    try:
+        ##Serialise up front so the file gets a single write instead of one per encoded chunk
+        data = json.dumps(index, indent=4)
+        with open(tmp_file, "w") as file:
+            file.write(data)
+            ##Make sure the contents are on disk before the rename, otherwise a crash can still leave an empty index
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, INDEX_FILE)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return True
+
 def main():
     args = parse_arguments()
 
@@ -411,6 +722,8 @@ def main():
         datefmt=LOGGER_DATE_FORMAT,
         style="$",
         handlers=[streamhandler])
+    if args.verbose:
+        _LOGGER.setLevel(logging.DEBUG)
 
     if DEBUGGING:
         msg = "Indexer running in DEBUG mode"    
@@ -424,12 +737,22 @@ def main():
 
     folder_setup()
 
-    updated_integration_index = create_integration_index(args.dev)
-    updated_platform_index = create_platform_index(args.dev)
+    if args.zstd:
+        _LOGGER.info("Compressing packages with Zstandard, unpacking them requires Python 3.14 or zipfile-zstd")
+        compression, compresslevel = ZIP_ZSTANDARD, ZSTD_COMPRESSION_LEVEL
+    elif args.dev:
+        compression, compresslevel = ZIP_COMPRESSION, DEV_COMPRESSION_LEVEL
+    else:
+        compression, compresslevel = ZIP_COMPRESSION, ZIP_COMPRESSION_LEVEL
+
+    if args.compresslevel is not None:
+        compresslevel = args.compresslevel
+    _LOGGER.debug(f"Using compression level {compresslevel}")
+
+    updated_integration_index = create_integration_index(args.dev, compression, compresslevel, args.jobs, args.check_unchanged)
+    updated_platform_index = create_platform_index(args.dev, compression, compresslevel, args.jobs, args.check_unchanged)
     index = {
-        "inkBoard": inkBoard.__version__,
-        "PythonScreenStackManager": PythonScreenStackManager.__version__,
-        "inkBoarddesigner": inkBoarddesigner.__version__,
+        **get_package_versions(),
         "timestamp": dt.now().isoformat(),
 
         ##For these indexes, maybe consider adding more file info?
@@ -437,15 +760,17 @@ def main():
 
         ##Also, start raising errors when versions on the main branch are typed as a dev version (i.e. have 3 '.'s)
         ##Maybe don't let the entire workflow fail but make it show a warning/error?
-        "platforms": updated_platform_index,
-        "integrations": updated_integration_index
+        ##Packages are sorted by name, so new packages do not end up in filesystem order
+        "platforms": dict(sorted(updated_platform_index.items())),
+        "integrations": dict(sorted(updated_integration_index.items()))
         }
 
-    print(index)
+    _LOGGER.debug("Generated index: %s", index)
 
-    with open(INDEX_FILE, "w") as file:
-        json.dump(index,file,indent=4)
-    print(f"Index dumped to {INDEX_FILE}")
+    if write_index(index):
+        _LOGGER.info(f"Index dumped to {INDEX_FILE}")
+    else:
+        _LOGGER.info("Index did not change, not updating the index file")
 
 if __name__ == "__main__":
     